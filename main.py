@@ -1,21 +1,42 @@
 import os
-import glob
+import functools
 import hashlib
+import json
+import mmap
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Any
+import numpy as np
+import torch
+import xxhash
+import openai
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from langchain_community.document_loaders import TextLoader
-from langchain_community.vectorstores import Chroma
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import Chroma, FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_huggingface import HuggingFaceEmbeddings
+from sentence_transformers.models import Pooling
 from langchain_text_splitters import (
     Language,
     RecursiveCharacterTextSplitter,
 )
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_openai import AzureChatOpenAI
 from cloudgpt_aoai import get_openai_token_provider
 load_dotenv()
 
+# LLM errors worth retrying; a summary that still fails with one of these is not cached
+TRANSIENT_LLM_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)
+
+# Let PyTorch use every available core for CPU-side work
+torch.set_num_threads(os.cpu_count())
+# Allow TF32 tensor cores for any fp32 matmuls left on the GPU
+torch.backends.cuda.matmul.allow_tf32 = True
+
 
 class CodeRepositoryRAG:
     """Simplified Code Repository RAG System"""
@@ -30,66 +51,229 @@ class CodeRepositoryRAG:
         self.vectorstore = None
         self.llm = None
         self.qa_chain = None
+        self._splitters = {}  # Text splitters cached per file extension
+        self._repo_hash_cache = {}  # Repository hashes cached per repo path
+        self._summary_cache_dirs = {}  # Summary cache directories cached per (repo path, granularity)
+        # Question embeddings cached so repeated questions skip the embedding model
+        self._embed_question = functools.lru_cache(maxsize=256)(self._embed_question_uncached)
 
         # Configuration
         self.granularity = granularity  # "chunk" or "file"
         self.embedding_model = "sentence-transformers/all-MiniLM-L6-v2"
+        self.embedding_backend = "torch"  # "torch" or "onnx-int8"
+        self.onnx_model_file = "onnx/model_quint8_avx2.onnx"  # Quantized export used by "onnx-int8"
+        self.embedding_dtype = torch.bfloat16  # Weight dtype for the "torch" backend
+        self.compile_embedder = True  # torch.compile the "torch" backend's encoder
         self.chunk_size = 500
         self.chunk_overlap = 200
+        self.embedding_batch_size = 128
+        self.insert_batch_size = 1024  # Documents embedded and written to Chroma per batch, capped at Chroma's limit
+        self.max_seq_length = 256  # Token limit per text; 500-char chunks rarely exceed it
+        self.max_file_size = 512_000  # Larger files are skipped when loading a repository
+        self.read_workers = 32  # Concurrent file reads when loading a repository
+        self.summary_workers = 16  # Concurrent LLM requests when summarizing files
+        self.vectorstore_backend = "chroma"  # "chroma" or "faiss-ivfpq"
+        self.faiss_min_chunks = 50_000  # "faiss-ivfpq" falls back to Chroma below this many chunks
+        self.faiss_index_factory = "IVF1024,PQ48"
+        self.faiss_nprobe = 32  # IVF lists scanned per query
         self.processed_repos_dir = "./processed_repos"
 
         print(f"RAG system initialized with {granularity} granularity")
 
     def _get_repo_hash(self, repo_path: str) -> str:
         """Generate a unique hash for the repository path"""
-        # Normalize path to handle different path separators
-        normalized_path = os.path.abspath(repo_path).replace(os.sep, '/')
-        return hashlib.md5(normalized_path.encode('utf-8')).hexdigest()[:8]
+        if repo_path not in self._repo_hash_cache:
+            # Normalize path to handle different path separators
+            normalized_path = os.path.abspath(repo_path).replace(os.sep, '/')
+            self._repo_hash_cache[repo_path] = hashlib.md5(normalized_path.encode('utf-8')).hexdigest()[:8]
+        return self._repo_hash_cache[repo_path]
 
     def _get_repo_persist_dir(self, repo_path: str) -> str:
         """Get the persist directory for a specific repository"""
         repo_hash = self._get_repo_hash(repo_path)
         return os.path.join(self.processed_repos_dir, repo_hash, self.granularity , "chroma_db")
 
+    def _get_manifest_path(self, repo_path: str) -> str:
+        """Get the path of the file manifest for a specific repository"""
+        repo_hash = self._get_repo_hash(repo_path)
+        return os.path.join(self.processed_repos_dir, repo_hash, self.granularity, "manifest.json")
+
+    def _get_faiss_dir(self, repo_path: str) -> str:
+        """Get the FAISS index directory for a specific repository"""
+        repo_hash = self._get_repo_hash(repo_path)
+        return os.path.join(self.processed_repos_dir, repo_hash, self.granularity, "faiss_index")
+
+    def _has_faiss_index(self, repo_path: str) -> bool:
+        """Check if repository was indexed with the FAISS backend"""
+        return os.path.exists(os.path.join(self._get_faiss_dir(repo_path), "index.faiss"))
+
     def _is_repo_processed(self, repo_path: str) -> bool:
         """Check if repository has already been processed"""
+        if self._has_faiss_index(repo_path):
+            return True
         persist_dir = self._get_repo_persist_dir(repo_path)
         return os.path.exists(persist_dir) and os.path.exists(os.path.join(persist_dir, "chroma.sqlite3"))
 
-    def load_code_files(self, repo_path: str) -> List[str]:
-        """Load code files"""
-        print(f"Loading code files: {repo_path}")
-        
+    def _iter_code_files(self, repo_path: str):
+        """Yield directory entries for code files in a single pass over the repository"""
         # Supported code file extensions
-        code_extensions = ['.py', '.js', '.java', '.cpp', '.c', '.h', '.txt', '.md']
-        
-        documents = []
-        for extension in code_extensions:
-            pattern = os.path.join(repo_path, f"**/*{extension}")
-            files = glob.glob(pattern, recursive=True)
-            
-            for file_path in files:
-                # Skip some unwanted files
-                skip_patterns = ['__pycache__', '.git', 'node_modules', '.log']
-                if any(pattern in file_path for pattern in skip_patterns):
-                    continue
-                
-                try:
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        content = f.read()
-                        if content.strip():  # Only process non-empty files
-                            documents.append({
-                                'content': content,
-                                'source': file_path,
-                                'extension': extension
-                            })
-                except Exception as e:
-                    print(f"Skipping file {file_path}: {e}")
-                    continue
-        
+        code_extensions = {'.py', '.js', '.java', '.cpp', '.c', '.h', '.txt', '.md'}
+        # Directories pruned before descending into them
+        skip_dirs = {'__pycache__', '.git', 'node_modules', 'vendor'}
+
+        pending_dirs = [repo_path]
+        while pending_dirs:
+            try:
+                with os.scandir(pending_dirs.pop()) as entries:
+                    for entry in entries:
+                        # Hidden files and directories are ignored, as with glob
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in skip_dirs:
+                                pending_dirs.append(entry.path)
+                        elif os.path.splitext(entry.name)[1] in code_extensions and entry.is_file():
+                            # Skip minified bundles and oversized (usually generated) files
+                            if '.min.' in entry.name:
+                                continue
+                            try:
+                                if entry.stat().st_size > self.max_file_size:
+                                    continue
+                            except OSError as e:
+                                print(f"Skipping file {entry.path}: {e}")
+                                continue
+                            yield entry
+            except OSError as e:
+                print(f"Skipping directory: {e}")
+
+    def _safe_read(self, file_path: str):
+        """Read a file and record its state at read time
+
+        Returns:
+            Tuple of the file content (None if the file is empty, binary or
+            unreadable) and a dict with the mtime, size and content hash of the
+            bytes that were read (None if the file is unreadable)
+        """
+        try:
+            with open(file_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                head = f.read(4096)
+
+                if len(head) < 4096:
+                    # The whole file is in head; skip binary and empty/whitespace-only
+                    # files before decoding
+                    file_hash = xxhash.xxh3_128_hexdigest(head)
+                    if b'\0' in head or not head.strip():
+                        content = None
+                    else:
+                        content = head.decode('utf-8', errors='ignore')
+                else:
+                    # Hash and decode large files straight from a memory map instead
+                    # of copying them through a buffered read first
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        file_hash = xxhash.xxh3_128_hexdigest(mm)
+                        content = None if b'\0' in head else str(mm, 'utf-8', 'ignore')
+        except Exception as e:
+            print(f"Skipping file {file_path}: {e}")
+            return None, None
+
+        file_state = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'hash': file_hash}
+
+        if content is not None:
+            # Normalize line endings as text-mode reads do
+            if '\r' in content:
+                content = content.replace('\r\n', '\n').replace('\r', '\n')
+
+            # Only process non-empty files
+            if not content.strip():
+                content = None
+
+        return content, file_state
+
+    def _read_documents(self, file_paths: List[str]):
+        """Read files into document dictionaries, dropping empty or unreadable ones
+
+        Returns:
+            Tuple of the documents and the read-time state of every readable file, keyed by path
+        """
+        # File reads are I/O-bound, so overlap them on a thread pool
+        with ThreadPoolExecutor(max_workers=self.read_workers) as executor:
+            results = list(executor.map(self._safe_read, file_paths))
+
+        documents = [
+            {
+                'content': content,
+                'source': file_path,
+                'extension': os.path.splitext(file_path)[1]
+            }
+            for file_path, (content, _) in zip(file_paths, results)
+            if content is not None
+        ]
+        file_states = {
+            file_path: file_state
+            for file_path, (_, file_state) in zip(file_paths, results)
+            if file_state is not None
+        }
+        return documents, file_states
+
+    def _load_code_files(self, repo_path: str):
+        """Load code files together with their read-time states"""
+        print(f"Loading code files: {repo_path}")
+
+        file_paths = [entry.path for entry in self._iter_code_files(repo_path)]
+        documents, file_states = self._read_documents(file_paths)
+
         print(f"Loaded {len(documents)} code files")
+        return documents, file_states
+
+    def load_code_files(self, repo_path: str) -> List[str]:
+        """Load code files"""
+        documents, _ = self._load_code_files(repo_path)
         return documents
 
+    def _hash_file(self, file_path: str) -> str:
+        """Compute a content hash, memory-mapping large files to avoid copying them"""
+        file_hash = xxhash.xxh3_128()
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 64 * 1024:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    file_hash.update(mm)
+            else:
+                file_hash.update(f.read())
+        return file_hash.hexdigest()
+
+    def _load_manifest(self, repo_path: str) -> Dict:
+        """Load the file manifest of a repository, or None if it has none"""
+        manifest_path = self._get_manifest_path(repo_path)
+
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception as e:
+                print(f"Failed to load manifest: {e}")
+                return None
+        return None
+
+    def _save_manifest(self, repo_path: str, manifest: Dict):
+        """Save the file manifest of a repository atomically"""
+        manifest_path = self._get_manifest_path(repo_path)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+        # Write to a temporary file first so an interrupted run never leaves a partial manifest
+        tmp_path = manifest_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, manifest_path)
+        except Exception as e:
+            print(f"Failed to save manifest: {e}")
+
+    def _get_file_state(self, file_path: str) -> Dict:
+        """Get the current mtime, size and content hash of a file on disk"""
+        stat = os.stat(file_path)
+        return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'hash': self._hash_file(file_path)}
+
     def process_documents(self, documents: List[Dict], repo_path: str) -> List[Dict]:
         """Process documents according to specified granularity
 
@@ -104,14 +288,33 @@ class CodeRepositoryRAG:
 
         if self.granularity == "file":
             # File-level processing: summarize each file and store both summary and original content
-            processed_docs = []
+            summaries = {}
+            uncached_docs = []
             for doc in documents:
-                print(f"Summarizing file: {doc['source']}")
-                # Generate summary using LLM
-                summary_text = self.summarize_file_content(doc['content'], doc['source'], repo_path)
+                cached_summary = self.load_summary(doc['source'], repo_path)
+                if cached_summary:
+                    print(f"Using cached summary for {doc['source']}")
+                    summaries[doc['source']] = cached_summary
+                else:
+                    uncached_docs.append(doc)
+
+            if uncached_docs:
+                if self.llm is None:
+                    self.setup_qa_system()
+
+                # LLM calls are network-bound, so issue them concurrently
+                with ThreadPoolExecutor(max_workers=self.summary_workers) as executor:
+                    futures = {
+                        executor.submit(self._summarize_one, doc['content'], doc['source'], repo_path): doc
+                        for doc in uncached_docs
+                    }
+                    for future in as_completed(futures):
+                        summaries[futures[future]['source']] = future.result()
 
+            processed_docs = []
+            for doc in documents:
                 processed_doc = {
-                    'content': summary_text,  # Summary text for embedding
+                    'content': summaries[doc['source']],  # Summary text for embedding
                     'source': doc['source'],
                     'extension': doc['extension'],
                     'chunk_id': 0,  # Single chunk per file
@@ -125,50 +328,81 @@ class CodeRepositoryRAG:
         else:  # chunk granularity
             return self.chunk_documents(documents)
 
+    def _get_splitter(self, extension: str) -> RecursiveCharacterTextSplitter:
+        """Get the text splitter for a file extension, creating it on first use"""
+        if extension not in self._splitters:
+            languages = {
+                '.py': Language.PYTHON,
+                '.js': Language.JS,
+                '.java': Language.JAVA,
+                '.cpp': Language.CPP,
+                '.c': Language.CPP,
+                '.h': Language.CPP,
+                '.md': Language.MARKDOWN
+            }
+            if extension in languages:
+                splitter = RecursiveCharacterTextSplitter.from_language(
+                    language=languages[extension],
+                    chunk_size=self.chunk_size,
+                    chunk_overlap=self.chunk_overlap
+                )
+            else:
+                # Plain text and other files use the generic separators
+                splitter = RecursiveCharacterTextSplitter(
+                    chunk_size=self.chunk_size,
+                    chunk_overlap=self.chunk_overlap
+                )
+            self._splitters[extension] = splitter
+        return self._splitters[extension]
+
     def chunk_documents(self, documents: List[Dict]) -> List[Dict]:
         """Chunk documents"""
         print("Chunking documents...")
-        
-        # Create text splitter
-        text_splitter = RecursiveCharacterTextSplitter.from_language(
-            language=Language.PYTHON,
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap
-        )
-        
-        all_chunks = []
+
+        # Group documents by extension so each splitter handles its files in one call
+        docs_by_extension = {}
         for doc in documents:
-            # Split text
-            chunks = text_splitter.split_text(doc['content'])
-            
-            # Add metadata to each chunk
-            for i, chunk in enumerate(chunks):
-                chunk_doc = {
-                    'content': chunk,
-                    'source': doc['source'],
-                    'extension': doc['extension'],
-                    'chunk_id': i
-                }
-                all_chunks.append(chunk_doc)
-        
+            docs_by_extension.setdefault(doc['extension'], []).append(doc)
+
+        all_chunks = []
+        for extension, docs in docs_by_extension.items():
+            chunks = self._get_splitter(extension).create_documents(
+                [doc['content'] for doc in docs],
+                metadatas=[{'source': doc['source']} for doc in docs]
+            )
+
+            # Number chunks within each source file
+            chunk_counts = {}
+            for chunk in chunks:
+                source = chunk.metadata['source']
+                chunk_id = chunk_counts.get(source, 0)
+                chunk_counts[source] = chunk_id + 1
+                all_chunks.append({
+                    'content': chunk.page_content,
+                    'source': source,
+                    'extension': extension,
+                    'chunk_id': chunk_id
+                })
+
         print(f"Documents split into {len(all_chunks)} chunks")
         return all_chunks
 
     def _get_summary_cache_path(self, file_path: str, repo_path: str) -> str:
         """Get the cache file path for a given file using project hash structure"""
-        # Get project hash for directory structure
-        repo_hash = self._get_repo_hash(repo_path)
-
-        # Create project-specific cache directory
-        project_cache_dir = os.path.join(self.processed_repos_dir, repo_hash, self.granularity, "summary_cache")
+        # Project-specific cache directory, computed once per repository
+        cache_key = (repo_path, self.granularity)
+        if cache_key not in self._summary_cache_dirs:
+            repo_hash = self._get_repo_hash(repo_path)
+            self._summary_cache_dirs[cache_key] = os.path.join(
+                self.processed_repos_dir, repo_hash, self.granularity, "summary_cache"
+            )
+        project_cache_dir = self._summary_cache_dirs[cache_key]
 
         # Use relative path from repo root, keeping directory structure
         rel_path = os.path.relpath(file_path, repo_path)
 
         # Create the full path with .txt extension
-        cache_path = os.path.join(project_cache_dir, rel_path + '.txt')
-
-        return cache_path
+        return project_cache_dir + os.sep + rel_path + '.txt'
 
     def load_summary(self, file_path: str, repo_path: str) -> str:
         """Load summary from cache if it exists"""
@@ -196,6 +430,37 @@ class CodeRepositoryRAG:
         except Exception as e:
             print(f"Failed to save summary to cache: {e}")
 
+    def _get_original_cache_path(self, file_path: str, repo_path: str) -> str:
+        """Get the path where the original content of a summarized file is stored"""
+        repo_hash = self._get_repo_hash(repo_path)
+        originals_dir = os.path.join(self.processed_repos_dir, repo_hash, self.granularity, "originals")
+        rel_path = os.path.relpath(file_path, repo_path)
+        return os.path.join(originals_dir, rel_path + '.txt')
+
+    def save_original(self, file_path: str, repo_path: str, content: str) -> str:
+        """Save original file content next to the vector store and return its path"""
+        original_path = self._get_original_cache_path(file_path, repo_path)
+
+        # Ensure originals directory exists
+        os.makedirs(os.path.dirname(original_path), exist_ok=True)
+
+        try:
+            with open(original_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            return original_path
+        except Exception as e:
+            print(f"Failed to save original content: {e}")
+            return None
+
+    def load_original(self, original_path: str) -> str:
+        """Load original file content saved by save_original"""
+        try:
+            with open(original_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except Exception as e:
+            print(f"Failed to load original content: {e}")
+            return None
+
     def summarize_file_content(self, file_content: str, file_path: str, repo_path: str) -> str:
         """Summarize file content using LLM with caching
 
@@ -213,10 +478,24 @@ class CodeRepositoryRAG:
             print(f"Using cached summary for {file_path}")
             return cached_summary
 
-        print(f"Generating new summary for {file_path}")
         if self.llm is None:
             self.setup_qa_system()
 
+        return self._summarize_one(file_content, file_path, repo_path)
+
+    def _summarize_one(self, file_content: str, file_path: str, repo_path: str) -> str:
+        """Generate a summary with the LLM and save it to cache
+
+        Args:
+            file_content: The content of the file to summarize
+            file_path: Path to the file for context
+            repo_path: Path to the repository root
+
+        Returns:
+            Summary text of the file content
+        """
+        print(f"Generating new summary for {file_path}")
+
         # Create summary prompt
         summary_prompt = f"""
         Please provide a concise but comprehensive summary of the following code file.
@@ -230,59 +509,455 @@ class CodeRepositoryRAG:
         Summary:
         """
 
+        # Fallback to first 500 characters if LLM fails
+        fallback_summary = file_content[:500] + "..." if len(file_content) > 500 else file_content
+
         try:
-            response = self.llm.invoke(summary_prompt)
+            response = self._invoke_llm(summary_prompt)
             summary = response.content.strip()
             # Save summary to cache
             self.save_summary(file_path, repo_path, summary)
             return summary
+        except TRANSIENT_LLM_ERRORS as e:
+            print(f"Failed to summarize file {file_path} after retries: {e}")
+            # Use the fallback for this run only so a later run retries the LLM
+            return fallback_summary
         except Exception as e:
             print(f"Failed to summarize file {file_path}: {e}")
-            # Fallback to first 500 characters if LLM fails
-            fallback_summary = file_content[:500] + "..." if len(file_content) > 500 else file_content
             # Save fallback summary to cache as well
             self.save_summary(file_path, repo_path, fallback_summary)
             return fallback_summary
 
-    def build_vectorstore(self, processed_docs: List[Dict], repo_path: str):
+    @retry(
+        retry=retry_if_exception_type(TRANSIENT_LLM_ERRORS),
+        # Jitter keeps concurrent summary workers from retrying in lockstep
+        wait=wait_random_exponential(multiplier=1, max=60),
+        stop=stop_after_attempt(6),
+        reraise=True
+    )
+    def _invoke_llm(self, prompt: str):
+        """Invoke the LLM, backing off exponentially with jitter on rate limits and transient errors"""
+        return self.llm.invoke(prompt)
+
+    def _ensure_embedder(self):
+        """Initialize the embedding model for the configured backend once and reuse it"""
+        if self.embeddings is not None:
+            return
+
+        if self.embedding_backend == "onnx-int8":
+            # Dynamically int8-quantized ONNX export, run by ONNX Runtime on CPU
+            model_kwargs = {
+                'device': 'cpu',
+                'backend': 'onnx',
+                'model_kwargs': {'file_name': self.onnx_model_file}
+            }
+        else:
+            # Load the weights directly in reduced precision instead of casting at
+            # runtime, with fused scaled-dot-product attention kernels
+            model_kwargs = {
+                'device': 'cuda',
+                'model_kwargs': {
+                    'torch_dtype': self.embedding_dtype,
+                    'attn_implementation': 'sdpa'
+                }
+            }
+
+        self.embeddings = HuggingFaceEmbeddings(
+            model_name=self.embedding_model,
+            model_kwargs=model_kwargs
+        )
+        self.embeddings._client.max_seq_length = self.max_seq_length
+
+        eager_model = None
+        if self.embedding_backend != "onnx-int8":
+            # Upcast pooled embeddings to fp32 so L2 normalization runs in full precision
+            for module in self.embeddings._client:
+                if isinstance(module, Pooling):
+                    module.register_forward_hook(self._upcast_pooled_embedding)
+
+            if self.compile_embedder:
+                # Dynamic shapes avoid a recompile for every padded batch length
+                transformer = self.embeddings._client[0]
+                eager_model = transformer.auto_model
+                transformer.auto_model = torch.compile(eager_model, mode="reduce-overhead", dynamic=True)
+
+        # Run a small batch up front so kernel selection, allocator setup and
+        # compilation are not paid by the first real batch
+        try:
+            self.embeddings._client.encode(["warmup"] * 8, batch_size=8)
+        except Exception as e:
+            if eager_model is None:
+                raise
+            # torch.compile only fails on the first call, e.g. without a usable compiler toolchain
+            print(f"Failed to compile embedding model, falling back to eager mode: {e}")
+            self.embeddings._client[0].auto_model = eager_model
+            self.embeddings._client.encode(["warmup"] * 8, batch_size=8)
+
+    @staticmethod
+    def _upcast_pooled_embedding(module, inputs, features: Dict) -> Dict:
+        """Forward hook casting the pooled sentence embedding to fp32"""
+        features['sentence_embedding'] = features['sentence_embedding'].float()
+        return features
+
+    def _encode_sorted(self, texts: List[str]) -> np.ndarray:
+        """Embed texts in length-sorted batches to minimize padding
+
+        Args:
+            texts: Texts to embed
+
+        Returns:
+            Embedding matrix with rows in the same order as texts
+        """
+        # Batch texts of similar length together, then restore the original order
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        sorted_texts = [texts[i] for i in order]
+
+        sorted_embeddings = self.embeddings._client.encode(
+            sorted_texts,
+            batch_size=self.embedding_batch_size,
+            show_progress_bar=False,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+
+        inverse = np.argsort(order)
+        return sorted_embeddings[inverse]
+
+    def _get_doc_id(self, doc: Dict) -> str:
+        """Get the vector store id of a processed document chunk/file"""
+        return f"{doc['source']}:{doc['chunk_id']}"
+
+    def _get_embedding_cache_path(self, text: str) -> str:
+        """Get the cache file path for the embedding of a text, keyed by model settings and content hash"""
+        # Every setting that changes the produced vectors is part of the key
+        if self.embedding_backend == "onnx-int8":
+            variant = self.onnx_model_file
+        else:
+            variant = str(self.embedding_dtype)
+        settings = f"{self.embedding_model}:{self.embedding_backend}:{variant}:{self.max_seq_length}"
+        key = xxhash.xxh3_128_hexdigest(f"{settings}\0{text}".encode('utf-8'))
+        return os.path.join(self.processed_repos_dir, "_embed_cache", key[:2], key + '.npy')
+
+    def _embed_cached(self, texts: List[str]) -> np.ndarray:
+        """Embed texts, reusing embeddings cached on disk from earlier runs
+
+        Args:
+            texts: Texts to embed
+
+        Returns:
+            Embedding matrix with rows in the same order as texts
+        """
+        cache_paths = [self._get_embedding_cache_path(text) for text in texts]
+
+        embeddings = [None] * len(texts)
+        missing = []
+        for i, cache_path in enumerate(cache_paths):
+            try:
+                embeddings[i] = np.load(cache_path).astype(np.float32)
+            except (OSError, ValueError, EOFError):
+                missing.append(i)
+
+        if missing:
+            computed = self._encode_sorted([texts[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+                try:
+                    os.makedirs(os.path.dirname(cache_paths[i]), exist_ok=True)
+                    # Write to a temporary file first so an interrupted write never leaves a partial entry
+                    tmp_path = cache_paths[i] + '.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        np.save(f, embedding.astype(np.float16))
+                    os.replace(tmp_path, cache_paths[i])
+                except OSError as e:
+                    print(f"Failed to save embedding to cache: {e}")
+
+        return np.stack(embeddings)
+
+    def _prepare_documents(self, processed_docs: List[Dict], repo_path: str):
+        """Get the texts, metadatas and ids stored in the vector store for processed documents"""
+        texts = [doc['content'] for doc in processed_docs]
+        metadatas = []
+        for doc in processed_docs:
+            metadata = {
+                'source': doc['source'],
+                'extension': doc['extension'],
+                'chunk_id': doc['chunk_id']
+            }
+            if 'original_content' in doc:
+                # Keep original file content out of the database, storing only where to find it
+                original_path = self.save_original(doc['source'], repo_path, doc['original_content'])
+                if original_path:
+                    metadata['original_path'] = original_path
+            metadatas.append(metadata)
+
+        ids = [self._get_doc_id(doc) for doc in processed_docs]
+        return texts, metadatas, ids
+
+    def _add_to_vectorstore(self, processed_docs: List[Dict], repo_path: str):
+        """Embed processed documents and insert them into the vector store"""
+        # Prepare document format for Chroma
+        texts, metadatas, ids = self._prepare_documents(processed_docs, repo_path)
+
+        # Visit texts in length order so every insert batch embeds similarly sized texts
+        order = np.argsort([len(text) for text in texts], kind="stable")
+
+        # Chroma rejects writes larger than its maximum batch size
+        batch_size = min(self.insert_batch_size, self.vectorstore._client.get_max_batch_size())
+
+        # Embed batch N+1 while a writer thread inserts batch N into Chroma
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending_writes = []
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                batch_texts = [texts[i] for i in batch]
+                embeddings = self._embed_cached(batch_texts)
+
+                pending_writes.append(writer.submit(
+                    self.vectorstore._collection.upsert,
+                    ids=[ids[i] for i in batch],
+                    embeddings=embeddings.tolist(),
+                    documents=batch_texts,
+                    metadatas=[metadatas[i] for i in batch]
+                ))
+                print(f"Embedded {min(start + batch_size, len(order))}/{len(order)} documents")
+
+            # Surface any insert errors
+            for future in pending_writes:
+                future.result()
+
+    def _update_manifest(self, manifest: Dict, processed_docs: List[Dict], repo_path: str, file_states: Dict):
+        """Record every read file and the documents built from it in the manifest
+
+        Args:
+            manifest: Manifest to update in place
+            processed_docs: List of processed document chunks/files
+            repo_path: Path to the repository
+            file_states: State of each file when it was read, keyed by path
+        """
+        chunk_ids = {}
+        for doc in processed_docs:
+            chunk_ids.setdefault(doc['source'], []).append(self._get_doc_id(doc))
+
+        # Empty and binary files are recorded too so they are not seen as new on every run
+        for file_path, file_state in file_states.items():
+            manifest[os.path.relpath(file_path, repo_path)] = dict(file_state, chunk_ids=chunk_ids.get(file_path, []))
+
+    def build_vectorstore(self, processed_docs: List[Dict], repo_path: str, file_states: Dict = None):
         """Build vector store from processed documents
 
         Args:
             processed_docs: List of processed document chunks/files
             repo_path: Path to the repository
+            file_states: State of each file when it was read, keyed by path; read
+                from disk when not given
         """
         print("Building vector store...")
 
         # Get repository-specific persist directory
         persist_dir = self._get_repo_persist_dir(repo_path)
 
-        # Initialize embedding model for M2 chip
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name=self.embedding_model,
-            model_kwargs={'device': 'cuda'}  # Use Metal Performance Shaders for M2
+        # Initialize embedding model
+        self._ensure_embedder()
+
+        if self.vectorstore_backend == "faiss-ivfpq" and len(processed_docs) > self.faiss_min_chunks:
+            self._build_faiss_index(processed_docs, repo_path)
+        else:
+            # An index left by an earlier FAISS build would shadow the Chroma store
+            if self._has_faiss_index(repo_path):
+                shutil.rmtree(self._get_faiss_dir(repo_path))
+
+            # Create vector store and insert the precomputed embeddings
+            self.vectorstore = Chroma(
+                persist_directory=persist_dir,
+                embedding_function=self.embeddings
+            )
+            if self.vectorstore._collection.count():
+                # A store left by an earlier build may hold chunks of files deleted since
+                self.vectorstore.delete_collection()
+                self.vectorstore = Chroma(
+                    persist_directory=persist_dir,
+                    embedding_function=self.embeddings
+                )
+            self._add_to_vectorstore(processed_docs, repo_path)
+
+        if file_states is None:
+            file_states = {}
+            for file_path in {doc['source'] for doc in processed_docs}:
+                try:
+                    file_states[file_path] = self._get_file_state(file_path)
+                except OSError as e:
+                    print(f"Failed to record {file_path} in manifest: {e}")
+
+        # Record file states so later runs only re-index what changed
+        manifest = {}
+        self._update_manifest(manifest, processed_docs, repo_path, file_states)
+        self._save_manifest(repo_path, manifest)
+
+        print("Vector store built successfully")
+
+    def _build_faiss_index(self, processed_docs: List[Dict], repo_path: str):
+        """Build and persist an IVF-PQ FAISS index, training it on the GPU when one is available
+
+        The trained index is copied back to the CPU, which serves all queries.
+
+        Args:
+            processed_docs: List of processed document chunks/files
+            repo_path: Path to the repository
+        """
+        import faiss
+
+        print(f"Building FAISS index ({self.faiss_index_factory}) for {len(processed_docs)} documents...")
+
+        texts, metadatas, ids = self._prepare_documents(processed_docs, repo_path)
+        embeddings = np.ascontiguousarray(self._embed_cached(texts), dtype=np.float32)
+
+        # Embeddings are L2-normalized, so inner product is cosine similarity
+        index = faiss.index_factory(embeddings.shape[1], self.faiss_index_factory, faiss.METRIC_INNER_PRODUCT)
+
+        # faiss wants roughly 39 training points per IVF centroid
+        rng = np.random.default_rng(0)
+        sample = embeddings[rng.choice(len(embeddings), min(len(embeddings), 50_000), replace=False)]
+
+        if faiss.get_num_gpus() > 0:
+            gpu_resources = faiss.StandardGpuResources()
+            cloner_options = faiss.GpuClonerOptions()
+            # fp32 lookup tables for 48 PQ sub-quantizers exceed GPU shared memory
+            cloner_options.useFloat16 = True
+            gpu_index = faiss.index_cpu_to_gpu(gpu_resources, 0, index, cloner_options)
+            gpu_index.train(sample)
+            gpu_index.add(embeddings)
+            index = faiss.index_gpu_to_cpu(gpu_index)
+        else:
+            print("No GPU available for FAISS, training on CPU")
+            index.train(sample)
+            index.add(embeddings)
+
+        self._prepare_faiss_index(index)
+
+        self.vectorstore = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore({
+                doc_id: Document(page_content=text, metadata=metadata)
+                for doc_id, text, metadata in zip(ids, texts, metadatas)
+            }),
+            index_to_docstore_id=dict(enumerate(ids)),
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
         )
+        self.vectorstore.save_local(self._get_faiss_dir(repo_path))
 
-        # Prepare document format for Chroma
-        texts = [doc['content'] for doc in processed_docs]
-        metadatas = [
-            {
-                'source': doc['source'],
-                'extension': doc['extension'],
-                'chunk_id': doc['chunk_id'],
-                'original_content': doc.get('original_content', doc['content'])  # Store original content in metadata
-            }
-            for doc in processed_docs
+    def _prepare_faiss_index(self, index):
+        """Configure a CPU IVF index for querying"""
+        import faiss
+
+        ivf_index = faiss.extract_index_ivf(index)
+        ivf_index.nprobe = self.faiss_nprobe
+        # MMR reads stored vectors back, which IVF indexes only support with a direct map
+        ivf_index.make_direct_map()
+
+    def update_vectorstore(self, repo_path: str):
+        """Re-index only the files that were added, changed or deleted since the last run
+
+        Args:
+            repo_path: Path to the repository
+        """
+        manifest = self._load_manifest(repo_path)
+        if manifest is None:
+            print("No manifest found, skipping incremental update")
+            return
+
+        print("Checking repository for changes...")
+
+        new_manifest = {}
+        changed_paths = []
+        seen_paths = set()
+        manifest_dirty = False  # Entries refreshed without needing a re-index
+        for entry in self._iter_code_files(repo_path):
+            rel_path = os.path.relpath(entry.path, repo_path)
+            seen_paths.add(rel_path)
+            record = manifest.get(rel_path)
+            try:
+                stat = entry.stat()
+                # Unchanged size and mtime: trust the recorded state without hashing
+                if record and record['mtime_ns'] == stat.st_mtime_ns and record['size'] == stat.st_size:
+                    new_manifest[rel_path] = record
+                    continue
+
+                file_hash = self._hash_file(entry.path)
+            except OSError as e:
+                print(f"Skipping file {entry.path}: {e}")
+                continue
+
+            if record and record['hash'] == file_hash:
+                # Touched but identical content
+                new_manifest[rel_path] = dict(record, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+                manifest_dirty = True
+            else:
+                changed_paths.append(entry.path)
+
+        deleted_paths = [rel_path for rel_path in manifest if rel_path not in seen_paths]
+
+        # Chunks of changed and deleted files are replaced or dropped
+        stale_ids = [
+            chunk_id
+            for rel_path, record in manifest.items()
+            if rel_path not in new_manifest
+            for chunk_id in record['chunk_ids']
         ]
 
-        # Create vector store
-        self.vectorstore = Chroma.from_texts(
-            texts=texts,
-            embedding=self.embeddings,
-            metadatas=metadatas,
-            persist_directory=persist_dir
-        )
+        if not changed_paths and not deleted_paths:
+            if manifest_dirty:
+                # Keep refreshed mtimes so touched files are not re-hashed on every run
+                self._save_manifest(repo_path, new_manifest)
+            print("Repository unchanged since last run")
+            return
 
-        print("Vector store built successfully")
+        print(f"Found {len(changed_paths)} new or changed files and {len(deleted_paths)} deleted files")
+
+        if self.granularity == "file":
+            # Original content of deleted files is no longer referenced
+            for rel_path in deleted_paths:
+                original_path = self._get_original_cache_path(os.path.join(repo_path, rel_path), repo_path)
+                if os.path.exists(original_path):
+                    os.remove(original_path)
+
+        if isinstance(self.vectorstore, FAISS):
+            # IVF-PQ indexes cannot be updated in place; rebuild, reusing cached summaries
+            # of unchanged files and cached embeddings of unchanged chunks
+            print("FAISS index does not support incremental updates, rebuilding...")
+            if self.granularity == "file":
+                for file_path in changed_paths:
+                    cache_path = self._get_summary_cache_path(file_path, repo_path)
+                    if os.path.exists(cache_path):
+                        os.remove(cache_path)
+
+            documents, file_states = self._load_code_files(repo_path)
+            if documents:
+                self.build_vectorstore(self.process_documents(documents, repo_path), repo_path, file_states)
+            return
+
+        # Chroma rejects deletes larger than its maximum batch size
+        max_batch_size = self.vectorstore._client.get_max_batch_size()
+        for start in range(0, len(stale_ids), max_batch_size):
+            self.vectorstore._collection.delete(ids=stale_ids[start:start + max_batch_size])
+
+        if changed_paths:
+            if self.granularity == "file":
+                # Cached summaries of changed files are outdated
+                for file_path in changed_paths:
+                    cache_path = self._get_summary_cache_path(file_path, repo_path)
+                    if os.path.exists(cache_path):
+                        os.remove(cache_path)
+
+            documents, file_states = self._read_documents(changed_paths)
+            processed_docs = []
+            if documents:
+                processed_docs = self.process_documents(documents, repo_path)
+                self._add_to_vectorstore(processed_docs, repo_path)
+            self._update_manifest(new_manifest, processed_docs, repo_path, file_states)
+
+        self._save_manifest(repo_path, new_manifest)
+        print("Vector store updated successfully")
 
     def load_existing_vectorstore(self, repo_path: str) -> bool:
         """Load existing vector store for a repository"""
@@ -296,16 +971,30 @@ class CodeRepositoryRAG:
             persist_dir = self._get_repo_persist_dir(repo_path)
 
             # Initialize embedding model (same as used for building)
-            self.embeddings = HuggingFaceEmbeddings(
-                model_name=self.embedding_model,
-                model_kwargs={'device': 'cuda'} 
-            )
+            self._ensure_embedder()
 
             # Load existing vector store
-            self.vectorstore = Chroma(
-                persist_directory=persist_dir,
-                embedding_function=self.embeddings
-            )
+            if self._has_faiss_index(repo_path):
+                if self.vectorstore_backend != "faiss-ivfpq":
+                    print(f"Existing FAISS index does not match the {self.vectorstore_backend} backend")
+                    return False
+
+                # The pickled docstore was written by build_vectorstore
+                self.vectorstore = FAISS.load_local(
+                    self._get_faiss_dir(repo_path),
+                    self.embeddings,
+                    allow_dangerous_deserialization=True,
+                    distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+                )
+                self._prepare_faiss_index(self.vectorstore.index)
+            else:
+                self.vectorstore = Chroma(
+                    persist_directory=persist_dir,
+                    embedding_function=self.embeddings
+                )
+                if self.vectorstore_backend == "faiss-ivfpq" and self.vectorstore._collection.count() > self.faiss_min_chunks:
+                    print("Existing Chroma store is large enough for the faiss-ivfpq backend")
+                    return False
 
             print("Existing vector store loaded successfully")
             return True
@@ -348,6 +1037,10 @@ class CodeRepositoryRAG:
         self.prompt = ChatPromptTemplate.from_template(template)
         print("Azure OpenAI QA system setup complete")
     
+    def _embed_question_uncached(self, question: str) -> tuple:
+        """Embed a question for retrieval"""
+        return tuple(self.embeddings.embed_query(question))
+
     def ask_question(self, question: str) -> Dict[str, Any]:
         """Ask a question"""
         if self.vectorstore is None or self.llm is None:
@@ -355,16 +1048,27 @@ class CodeRepositoryRAG:
         
         print(f"Processing question: {question}")
         
-        # Retrieve relevant documents
-        retriever = self.vectorstore.as_retriever(search_kwargs={"k": 5})
-        relevant_docs = retriever.get_relevant_documents(question)
+        # Retrieve relevant documents with MMR so near-duplicate results do not crowd the context
+        relevant_docs = self.vectorstore.max_marginal_relevance_search_by_vector(
+            list(self._embed_question(question)),
+            k=5,
+            fetch_k=25,
+            lambda_mult=0.5
+        )
 
         # Merge context - use original content for files, page_content for chunks
         context_parts = []
         for doc in relevant_docs:
-            if self.granularity == "file" and 'original_content' in doc.metadata:
+            original_content = None
+            if self.granularity == "file" and 'original_path' in doc.metadata:
                 # For file granularity, use the original file content
-                context_parts.append(doc.metadata['original_content'])
+                original_content = self.load_original(doc.metadata['original_path'])
+            elif self.granularity == "file" and 'original_content' in doc.metadata:
+                # Stores built before originals moved out of the metadata
+                original_content = doc.metadata['original_content']
+
+            if original_content is not None:
+                context_parts.append(original_content)
             else:
                 # For chunk granularity, use the chunk content
                 context_parts.append(doc.page_content)
@@ -404,6 +1108,9 @@ class CodeRepositoryRAG:
             print("Repository already processed, loading existing data...")
             # Try to load existing vector store
             if self.load_existing_vectorstore(repo_path):
+                # Re-index files changed since the last run
+                self.update_vectorstore(repo_path)
+
                 # Setup QA system
                 self.setup_qa_system()
                 print("RAG system ready! (loaded from cache)")
@@ -415,7 +1122,7 @@ class CodeRepositoryRAG:
         print("Processing repository from scratch...")
 
         # 1. Load code files
-        documents = self.load_code_files(repo_path)
+        documents, file_states = self._load_code_files(repo_path)
         if not documents:
             print("No code files found")
             return False
@@ -424,7 +1131,7 @@ class CodeRepositoryRAG:
         processed_docs = self.process_documents(documents, repo_path)
 
         # 3. Build vector store
-        self.build_vectorstore(processed_docs, repo_path)
+        self.build_vectorstore(processed_docs, repo_path, file_states)
 
         # 4. Setup QA system
         self.setup_qa_system()